@@ -0,0 +1,42 @@
+import numpy as np
+
+
+# канонизация циклических паттернов длины 5 (браслетов) с точностью до поворотов и отражений:
+# паттерн упакован в uint64 (40 бит, позиция 0 в старшем байте), представитель класса -
+# минимальный образ, что совпадает с лексикографическим минимумом bytes; батчи обрабатываются целиком
+
+# 10 действий группы D5 на 5 позициях (5 поворотов + 5 отражений) и упаковка 5 байт в uint64
+_ROT5 = np.array([np.roll(np.arange(5), -k) for k in range(5)], dtype=np.intp)
+ROT10 = np.concatenate([_ROT5, _ROT5[:, ::-1]])
+PACK_SHIFTS = np.arange(32, -1, -8, dtype=np.uint64)
+BYTE = np.uint64(0xFF)
+MASK40 = np.uint64((1 << 40) - 1)
+
+def pack_n5(rows):
+    """
+    Батч паттернов (N, 5) uint8 -> (N,) uint64, позиция 0 в старшем байте (порядок как у bytes)
+    """
+    return (rows.astype(np.uint64) << PACK_SHIFTS).sum(axis=-1)
+
+def _rot_n5(x, k):
+    # сдвиг на k позиций влево внутри 40 бит: новая позиция i = старая (i + k) % 5
+    if k == 0: return x
+    return ((x << np.uint64(8 * k)) | (x >> np.uint64(8 * (5 - k)))) & MASK40
+
+def _rev_n5(x):
+    # отражение: новая позиция i = старая 4 - i
+    return (
+        ((x & BYTE) << np.uint64(32)) | (((x >> np.uint64(8)) & BYTE) << np.uint64(24)) | (x & (BYTE << np.uint64(16)))
+        | (((x >> np.uint64(24)) & BYTE) << np.uint64(8)) | (x >> np.uint64(32))
+    )
+
+def bracelet_canon_n5(keys, actions=range(10)):
+    """
+    SWAR-канонизация упакованных паттернов длины 5: минимум образов под действиями D5 (индексы строк ROT10)
+    """
+    canon = None
+    for j in actions:
+        x = _rot_n5(keys, j % 5)
+        if j >= 5: x = _rev_n5(x)
+        canon = x if canon is None else np.minimum(canon, x)
+    return canon
@@ -1,7 +1,13 @@
+import numpy as np
 import pandas as pd
-from itertools import product, combinations
+import pyarrow as pa
+import pyarrow.compute as pc
+from functools import lru_cache
+from itertools import combinations
 from tqdm import tqdm
 
+from _necklace import PACK_SHIFTS, ROT10, bracelet_canon_n5, pack_n5
+
 
 # заместители и ключевые элементы (таблицы 3, 4)
 C_STAR = "[#6](*)"
@@ -18,112 +24,172 @@ SUBSTITUENT_CATALOG = {
 }
 APPLICABLE_SUBSTITUENTS = list(SUBSTITUENT_CATALOG.keys())
 
+# словарь токенов: пара (атом, метка) -> uint8 = (id атома << 4) | id метки, паттерны храним как bytes
+ATOMS = [C_STAR, N_NOSTAR, N_STAR, O_ATOM, S_ATOM]
+TAGS = ["", "H", "*", *APPLICABLE_SUBSTITUENTS]
+TAG_BITS = 4
+TAG_MASK = (1 << TAG_BITS) - 1
+TOKEN_ID = {(atom, tag): (a << TAG_BITS) | t for a, atom in enumerate(ATOMS) for t, tag in enumerate(TAGS)}
+ID_TOKEN = {i: token for token, i in TOKEN_ID.items()}
+H_TAG = TAGS.index("H")
+STAR_TAG = TAGS.index("*")
+LABEL_TAG_BASE = TAGS.index(APPLICABLE_SUBSTITUENTS[0])
+
+# скелеты L1 как 4-битные маски (бит 3 - i = 1 <=> N в позиции i)
+_M4 = np.arange(16, dtype=np.uint8)
+BITREV4 = ((_M4 & 1) << 3) | ((_M4 & 2) << 1) | ((_M4 & 4) >> 1) | ((_M4 & 8) >> 3)
+REFLECT4 = np.minimum(_M4, BITREV4)
+POPCNT4 = np.array([bin(m).count("1") for m in range(16)], dtype=np.uint8)
+SKEL4 = [bytes(TOKEN_ID[(N_NOSTAR if (m >> (3 - i)) & 1 else C_STAR, "")] for i in range(4)) for m in range(16)]
+
+
+def _mask_templates(center_star, skel_bits):
+    # метки L3 (2 или 3 позиции "*", остальные свободные - H) в порядке перебора combinations
+    free_pos = [0] * center_star + [1 + i for i in range(4) if not (skel_bits >> (3 - i)) & 1]
+    templates = []
+    for k in (2, 3):
+        for indices in combinations(free_pos, k):
+            tags = bytearray(5)
+            for i in free_pos:
+                tags[i] = STAR_TAG if i in indices else H_TAG
+            templates.append(bytes(tags))
+    return np.frombuffer(b"".join(templates), dtype=np.uint8).reshape(-1, 5)
+
+# шаблоны масок L3 по (есть ли "(*)" у центра, 4-битная маска скелета); маска = ядро | шаблон
+MASK_TEMPLATES = {(star, m): _mask_templates(star, m) for star in (False, True) for m in range(16)}
 
-#  вспомогательные функции
-def canonical_reflect_tuple(seq):
-    return min(tuple(seq), tuple(reversed(seq)))
 
-def canonical_necklace(seq):
+#  вспомогательные функции
+def strip_tags(pattern):
     """
-    Канонизация с поворотами
+    Паттерн без меток: для маски L3 - её ядро L2 (центр + скелет)
     """
-    n = len(seq)
-    reps = {tuple(seq), tuple(reversed(seq))}
-    fwd = list(seq)
-    rev = list(reversed(seq))
-    for _ in range(n - 1):
-        fwd = fwd[1:] + fwd[:1]
-        rev = rev[1:] + rev[:1]
-        reps.add(tuple(fwd))
-        reps.add(tuple(rev))
-    return min(reps)
+    return bytes(t >> TAG_BITS << TAG_BITS for t in pattern)
+
+def _token_smarts(atom, tag):
+    if tag == "H":
+        return atom.replace("(*)", f"({H_TOKEN})")
+    if tag and tag != "*":
+        return atom.replace("(*)", f"({SUBSTITUENT_CATALOG[tag]})")
+    return atom
+
+def _add_ring_label(atom_str):
+    if ":1" in atom_str: return atom_str
+    return atom_str.replace("]", ":1]", 1) if "]" in atom_str else f"[{atom_str}:1]"
+
+# готовые SMARTS-фрагменты по id токена: первый атом кольца (с меткой :1) и остальные
+SMARTS_TAIL = [_token_smarts(*ID_TOKEN[i]) if i in ID_TOKEN else None for i in range(len(ATOMS) << TAG_BITS)]
+SMARTS_HEAD = [_add_ring_label(part) if part else None for part in SMARTS_TAIL]
 
 def build_smarts(pattern, level):
     """
-    Сборка SMARTS
+    Сборка SMARTS по паттерну из id токенов (для level 2 - скелет без центра)
     """
     if level == 1: return L0_SMARTS
 
-    def add_ring_label(atom_str):
-        if ":1" in atom_str: return atom_str
-        return atom_str.replace("]", ":1]", 1) if "]" in atom_str else f"[{atom_str}:1]"
-
-    parts = []
-    for i, p_str in enumerate(pattern):
-        atom, tag = (p_str.split('|', 1) + [''])[:2]
-        
-        current_part = atom
-        if tag == "H":
-            current_part = atom.replace("(*)", f"({H_TOKEN})")
-        elif tag and tag != "*":
-            current_part = atom.replace("(*)", f"({SUBSTITUENT_CATALOG[tag]})")
-        
-        if i == 0:
-            if level == 2:
-                current_part = "[a:1]"
-            else:
-                current_part = add_ring_label(current_part)
-
-        parts.append(current_part)
-
-    return parts[0] + "1:" + ":".join(parts[1:]) + ":1"
+    if level == 2:
+        head, tail = "[a:1]", pattern
+    else:
+        head, tail = SMARTS_HEAD[pattern[0]], pattern[1:]
+
+    return "".join((head, "1:", ":".join([SMARTS_TAIL[t] for t in tail]), ":1"))
+
+@lru_cache(maxsize=None)
+def _parent_smarts(pattern, level):
+    # SMARTS слоёв 1-4 повторяются для общих скелетов и ядер; layer5 уникален и не кэшируется
+    return build_smarts(pattern, level)
 
 #  основной генератор
 def generate_hierarchical_library():
 
     # L1: скелеты
-    choices = [C_STAR, N_NOSTAR]
-    layer1_skeletons = list({canonical_reflect_tuple(s): s for s in product(choices, repeat=4) if s.count(N_NOSTAR) <= 2}.values())
+    # классы упорядочены по первому появлению, представитель - старшая маска (как в переборе product)
+    m = np.arange(16, dtype=np.uint8)
+    canon = np.unique(REFLECT4[m[POPCNT4[m] <= 2]])
+    layer1_skeletons = np.maximum(canon, BITREV4[canon]).tolist()
 
     # L2: ядра
-    centers = [C_STAR, N_STAR, O_ATOM, S_ATOM]
-    layer2_cores_h = [((skel, (center,) + skel)) for skel in layer1_skeletons for center in centers]
+    centers = [TOKEN_ID[(atom, "")] for atom in (C_STAR, N_STAR, O_ATOM, S_ATOM)]
+    layer2_cores_h = [(skel, bytes([center]) + SKEL4[skel]) for skel in layer1_skeletons for center in centers]
 
     # L3: маски
-    layer3_masks_h = []
+    layer3_masks = []
     for skel, core in tqdm(layer2_cores_h, desc="Generating L3 (Masks)"):
-        free_pos = [i for i, token in enumerate(core) if "(*)" in token]
-        for k in (2, 3):
-            if len(free_pos) < k: continue
-            for indices in combinations(free_pos, k):
-                mask = tuple(f"{atom}|*" if i in indices else f"{atom}|H" if "(*)" in atom else f"{atom}|" for i, atom in enumerate(core))
-                layer3_masks_h.append((skel, core, mask))
-    
-    unique_masks = {canonical_necklace(m): (s, c, m) for s, c, m in layer3_masks_h}
+        center_star = "(*)" in ATOMS[core[0] >> TAG_BITS]
+        layer3_masks.append(np.frombuffer(core, dtype=np.uint8) | MASK_TEMPLATES[(center_star, skel)])
+    layer3_masks = np.concatenate(layer3_masks)
+
+    # представитель класса - последняя встреченная маска; скелет и ядро восстанавливаются из маски
+    mask_keys = bracelet_canon_n5(pack_n5(layer3_masks))
+    _, last_idx = np.unique(mask_keys[::-1], return_index=True)
+    unique_masks = [mask.tobytes() for mask in layer3_masks[::-1][last_idx]]
     
     # L4: добавление заместителей
-    final_hierarchy = []
-    for skel, core, mask in tqdm(unique_masks.values(), desc="Generating L4 (Substituents)"):
-        star_pos = [i for i, p in enumerate(mask) if p.endswith("|*")]
-        for labels in product(APPLICABLE_SUBSTITUENTS, repeat=len(star_pos)):
-            final_pat = list(mask)
-            for i, pos in enumerate(star_pos):
-                final_pat[pos] = f"{mask[pos].split('|')[0]}|{labels[i]}"
-            final_hierarchy.append((skel, core, mask, tuple(final_pat)))
-
-    # сборка таблицы
-    final_data = {}
-    parent_smarts_cache = {}
-    
-    for skeleton_pat, core_pat, mask_pat, final_pat in tqdm(final_hierarchy, desc="Building DataFrame"):
-        canon_final_pat = canonical_necklace(final_pat)
-        if canon_final_pat not in final_data:
-            key_cache = (skeleton_pat, core_pat, mask_pat)
-            if key_cache not in parent_smarts_cache:
-                parent_smarts_cache[key_cache] = {
-                    "layer1_smarts": build_smarts(None, level=1),
-                    "layer2_smarts": build_smarts(('a',) + skeleton_pat, level=2),
-                    "layer3_smarts": build_smarts(core_pat, level=3),
-                    "layer4_smarts": build_smarts(mask_pat, level=4),
-                }
-            
-            final_data[canon_final_pat] = {
-                **parent_smarts_cache[key_cache],
-                "layer5_smarts": build_smarts(final_pat, level=5)
-            }
-
-    df = pd.DataFrame.from_dict(final_data, orient='index')
-    return df.sort_values(by=list(df.columns)).reset_index(drop=True)
+    n_labels = len(APPLICABLE_SUBSTITUENTS)
+    label_grids = {
+        k: np.stack(np.meshgrid(*[np.arange(n_labels, dtype=np.uint8)] * k, indexing="ij"), axis=-1).reshape(-1, k)
+        for k in (2, 3)
+    }
+    # маски с одинаковым числом позиций "*" обрабатываются одним батчем (n_masks, n_labels**k)
+    mask_groups = {}
+    for mask_id, mask in enumerate(unique_masks):
+        k = sum(t & TAG_MASK == STAR_TAG for t in mask)
+        mask_groups.setdefault(k, []).append(mask_id)
+
+    # фаза 1: колонки (SoA) упакованных паттернов, их канонических ключей и id родительской маски
+    final_pats, canon_keys, mask_idx = [], [], []
+    for k, mask_ids in tqdm(mask_groups.items(), desc="Generating L4 (Substituents)"):
+        grid = label_grids[k].astype(np.uint64)
+        masks = np.frombuffer(b"".join(unique_masks[i] for i in mask_ids), dtype=np.uint8).reshape(len(mask_ids), -1)
+        star_shifts = PACK_SHIFTS[np.nonzero((masks & TAG_MASK) == STAR_TAG)[1].reshape(len(mask_ids), k)]
+        # метка "*" в байте позиции заменяется на метку заместителя прибавлением разницы id
+        pats = np.broadcast_to(pack_n5(masks)[:, None], (len(mask_ids), len(grid))).copy()
+        for j in range(k):
+            pats += (LABEL_TAG_BASE - STAR_TAG + grid[:, j]) << star_shifts[:, [j]]
+
+        # эквивалентные паттерны одной маски связаны только элементами её стабилизатора в D5,
+        # поэтому ключ - минимум образов паттерна под стабилизатором (маски группируются по нему);
+        # при тривиальном стабилизаторе все строки различны и ключом служит сам паттерн.
+        # Ключ всегда образ самого паттерна, а классы разных масок не пересекаются,
+        # поэтому ключи разных масок не совпадают
+        canon = pats.copy()
+        stabs = (masks[:, ROT10] == masks[:, None, :]).all(axis=-1)
+        for stab in np.unique(stabs[stabs.sum(axis=1) > 1], axis=0):
+            rows = (stabs == stab).all(axis=1)
+            canon[rows] = bracelet_canon_n5(canon[rows], np.flatnonzero(stab))
+
+        final_pats.append(pats.reshape(-1))
+        canon_keys.append(canon.reshape(-1))
+        mask_idx.append(np.repeat(np.asarray(mask_ids, dtype=np.uint32), len(grid)))
+
+    final_pats = np.concatenate(final_pats)
+    mask_idx = np.concatenate(mask_idx)
+
+    # фаза 2: выжившие - первые в порядке перебора представители каждого класса
+    _, first_idx = np.unique(np.concatenate(canon_keys), return_index=True)
+
+    # фаза 3: SMARTS слоёв 1-4 зависят только от маски и считаются один раз на маску,
+    # по выжившим строкам собирается только layer5
+    cores = [strip_tags(mask) for mask in unique_masks]
+    parent_smarts = {
+        "layer1_smarts": [_parent_smarts(None, level=1)] * len(unique_masks),
+        "layer2_smarts": [_parent_smarts(core[1:], level=2) for core in cores],
+        "layer3_smarts": [_parent_smarts(core, level=3) for core in cores],
+        "layer4_smarts": [_parent_smarts(mask, level=4) for mask in unique_masks],
+    }
+    survivor_masks = pa.array(mask_idx[first_idx])
+
+    # big-endian uint64: паттерн - младшие 5 байт каждого 8-байтового слова
+    buf = final_pats[first_idx].astype(">u8").tobytes()
+    layer5_smarts = [build_smarts(buf[i - 5:i], level=5) for i in range(8, len(buf) + 1, 8)]
+
+    # сортировка по всем колонкам - строковая, через arrow (без многоключевой сортировки object-колонок в pandas)
+    table = pa.table({
+        **{name: pa.array(column).take(survivor_masks) for name, column in parent_smarts.items()},
+        "layer5_smarts": layer5_smarts,
+    })
+    order = pc.sort_indices(table, sort_keys=[(name, "ascending") for name in table.column_names])
+    return table.take(order).to_pandas()
 
 if __name__ == "__main__":
     df = generate_hierarchical_library()